@@ -1,5 +1,7 @@
 import json
 import sqlite3
+import threading
+from contextlib import contextmanager
 from pathlib import Path
 
 DB_PATH = Path(__file__).resolve().parent.parent / "mcp_logger.db"
@@ -43,6 +45,17 @@ WORKOUT_TABLES_SQL = [
         FOREIGN KEY(exercise_id) REFERENCES exercises(id) ON DELETE CASCADE
     )
     """,
+    # One row per workout tag, with the workout's date_time copied alongside so tag
+    # lookups are answered from the (tag, date_time) index. Written by log_workout.
+    """
+    CREATE TABLE IF NOT EXISTS workout_tags (
+        workout_id INTEGER NOT NULL,
+        tag TEXT NOT NULL COLLATE NOCASE,
+        date_time TEXT NOT NULL,
+        FOREIGN KEY(workout_id) REFERENCES workouts(id) ON DELETE CASCADE,
+        UNIQUE(workout_id, tag)
+    )
+    """,
 ]
 
 NUTRITION_TABLES_SQL = [
@@ -104,46 +117,182 @@ BODY_TABLES_SQL = [
     """,
 ]
 
+
+def _fts_sql(fts: str, table: str, columns: tuple[str, ...], options: str) -> list[str]:
+    """An external-content FTS5 index over table's columns and the triggers that sync it."""
+    names = ", ".join(columns)
+    new_values = ", ".join(f"new.{column}" for column in columns)
+    old_values = ", ".join(f"old.{column}" for column in columns)
+    insert = f"INSERT INTO {fts}(rowid, {names}) VALUES (new.id, {new_values});"
+    delete = f"INSERT INTO {fts}({fts}, rowid, {names}) VALUES ('delete', old.id, {old_values});"
+    return [
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {fts} USING fts5({names}, content='{table}', content_rowid='id'{options})",
+        f"CREATE TRIGGER IF NOT EXISTS {fts}_insert AFTER INSERT ON {table} BEGIN {insert} END",
+        f"CREATE TRIGGER IF NOT EXISTS {fts}_delete AFTER DELETE ON {table} BEGIN {delete} END",
+        f"CREATE TRIGGER IF NOT EXISTS {fts}_update AFTER UPDATE OF {names} ON {table} BEGIN {delete} {insert} END",
+    ]
+
+
+# Full-text indexes searched by search_logs: name -> (table, columns, extra fts5 options)
+FTS_TABLES = {
+    "workouts_fts": ("workouts", ("notes", "workout_type", "tags"), ""),
+    # Trigram index so substrings of the short workout_type/tags values match too
+    "workouts_tags_fts": ("workouts", ("workout_type", "tags"), ", tokenize='trigram'"),
+    "nutrition_days_fts": ("nutrition_days", ("notes",), ""),
+    "body_metrics_fts": ("body_metrics", ("notes",), ""),
+}
+FTS_TABLES_SQL = [statement for fts, spec in FTS_TABLES.items() for statement in _fts_sql(fts, *spec)]
+
+PRAGMAS_SQL = [
+    "PRAGMA journal_mode = WAL",
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA temp_store = MEMORY",
+    "PRAGMA mmap_size = 268435456",
+    "PRAGMA cache_size = -65536",
+    "PRAGMA foreign_keys = ON",
+]
+
 SEARCH_TABLES_SQL = [
     """
     CREATE INDEX IF NOT EXISTS idx_workouts_date_time ON workouts (date_time);
     """,
+    # Child lookups by foreign key, ordered the way the tools read them back
+    """
+    CREATE INDEX IF NOT EXISTS idx_exercises_workout ON exercises (workout_id, order_index);
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS idx_sets_exercise ON sets (exercise_id, set_index);
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS idx_meals_day ON meals (day_id, order_index);
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS idx_meal_items_meal ON meal_items (meal_id);
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS idx_skinfolds_metrics ON skinfolds (body_metrics_id);
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS idx_exercises_name_nocase ON exercises (name COLLATE NOCASE);
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS idx_workout_tags_tag ON workout_tags (tag, date_time DESC, workout_id);
+    """,
+    # Covering indexes for the date-ordered listings (summaries, body metrics, blank
+    # searches): every column those queries read, so rows never need a table lookup
+    """
+    CREATE INDEX IF NOT EXISTS idx_nutrition_days_date_cover ON nutrition_days (date, notes);
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS idx_body_metrics_date_cover ON body_metrics (date, body_weight_kg, notes);
+    """,
+]
+
+# Fill workout_tags from workouts.tags for databases created before the table existed
+BACKFILL_SQL = [
+    """
+    INSERT OR IGNORE INTO workout_tags (workout_id, tag, date_time)
+    SELECT workouts.id, json_each.value, workouts.date_time
+    FROM workouts, json_each(workouts.tags)
+    WHERE json_valid(workouts.tags) AND json_each.value IS NOT NULL
+      AND NOT EXISTS (SELECT 1 FROM workout_tags)
+    """,
 ]
 
 
 def get_connection():
-    conn = sqlite3.connect(DB_PATH)
+    # Autocommit mode: transactions are opened explicitly by connection()/transaction().
+    # The statement cache is sized above the number of distinct SQL texts the tools
+    # generate (one per filter combination), so long-lived connections never re-prepare.
+    conn = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None, cached_statements=256)
     conn.row_factory = sqlite3.Row
-    # Enable foreign key constraints
-    conn.execute("PRAGMA foreign_keys = ON")
+    for statement in PRAGMAS_SQL:
+        conn.execute(statement)
     return conn
 
 
-def _initialize_tables():
-    conn = get_connection()
-    cursor = conn.cursor()
+# One writer shared by every tool call and serialized by the lock. Reads use a
+# connection per worker thread, which WAL lets run alongside the writer.
+_WRITER = get_connection()
+_WRITER_LOCK = threading.Lock()
+_readers = threading.local()
+_generation = 0
+
+
+def write_generation() -> int:
+    """Number of committed write transactions; changes whenever stored data may have."""
+    return _generation
 
-    for statement in (*WORKOUT_TABLES_SQL, *NUTRITION_TABLES_SQL, *BODY_TABLES_SQL, *SEARCH_TABLES_SQL):
-        cursor.execute(statement)
 
-    conn.commit()
-    conn.close()
+def _reader() -> sqlite3.Connection:
+    conn = getattr(_readers, "conn", None)
+    if conn is None:
+        conn = _readers.conn = get_connection()
+        conn.execute("PRAGMA query_only = ON")
+    return conn
+
+
+@contextmanager
+def connection():
+    """Yield this thread's read-only connection inside a snapshot transaction."""
+    conn = _reader()
+    conn.execute("BEGIN")
+    try:
+        yield conn
+    finally:
+        # Nothing was written; ending the transaction just releases the snapshot
+        conn.rollback()
+
+
+@contextmanager
+def transaction():
+    """Yield the shared write connection inside a write transaction."""
+    global _generation
+    with _WRITER_LOCK:
+        _WRITER.execute("BEGIN IMMEDIATE")
+        try:
+            yield _WRITER
+            # Inside the try: a COMMIT rejected by deferred constraints leaves the
+            # transaction open, and the shared writer must not be left in it
+            _WRITER.commit()
+        except BaseException:
+            _WRITER.rollback()
+            raise
+        _generation += 1
+
+
+def _initialize_tables():
+    with transaction() as conn:
+        existing = {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'table'")}
+        for statement in (
+            *WORKOUT_TABLES_SQL, *NUTRITION_TABLES_SQL, *BODY_TABLES_SQL,
+            *SEARCH_TABLES_SQL, *FTS_TABLES_SQL, *BACKFILL_SQL,
+        ):
+            conn.execute(statement)
+        # Index the rows written before a full-text table existed
+        for fts in FTS_TABLES:
+            if fts not in existing:
+                conn.execute(f"INSERT INTO {fts}({fts}) VALUES ('rebuild')")
 
 
 _initialize_tables()
 
 
+# Built once: json.dumps constructs a new encoder per call whenever options are passed
+_TAGS_ENCODER = json.JSONEncoder(separators=(",", ":"))
+_TAGS_DECODER = json.JSONDecoder()
+
+
 def serialize_tags(tags: list[str] | None) -> str | None:
     if tags is None:
         return None
-    return json.dumps(tags)
+    return _TAGS_ENCODER.encode(tags)
 
 
 def deserialize_tags(text: str | None) -> list[str]:
     if not text:
         return []
     try:
-        return json.loads(text)
+        return _TAGS_DECODER.decode(text)
     except json.JSONDecodeError:
         return []
-
@@ -1,22 +1,53 @@
 """MCP Logger server using FastMCP stdio interface."""
 
+import asyncio
 import json
 import sqlite3
+import threading
+import time
+from collections import OrderedDict, defaultdict
 from datetime import datetime
+from functools import lru_cache, wraps
+from itertools import combinations, product
+from operator import itemgetter
 from pathlib import Path
-from typing import Any, Optional
+from typing import Any, Callable, Literal, Optional
 
 from fastmcp import FastMCP
 
-from .db import get_connection, serialize_tags, deserialize_tags
+from .db import FTS_TABLES, connection, transaction, serialize_tags, deserialize_tags, write_generation
 
 app = FastMCP("MCP Logger")
 
 
+def _tool(fn: Callable[..., Any]) -> Any:
+    """Register a blocking tool as an async MCP tool that runs in a worker thread.
+
+    SQLite calls then no longer hold up the event loop, and concurrent requests read
+    through their own thread's connection.
+    """
+
+    @wraps(fn)
+    async def run(*args: Any, **kwargs: Any) -> Any:
+        return await asyncio.to_thread(fn, *args, **kwargs)
+
+    return app.tool()(run)
+
+
 def _row_to_dict(row: sqlite3.Row) -> dict[str, Any]:
     return dict(row)
 
 
+def _fetch_dicts(cursor: sqlite3.Cursor) -> list[dict[str, Any]]:
+    """Fetch the remaining rows as dicts, resolving column names once per query.
+
+    dict(row) looks every column up by name; zipping against the names is cheaper.
+    """
+    keys = [column[0] for column in cursor.description]
+    return [dict(zip(keys, row)) for row in cursor]
+
+
+@lru_cache(maxsize=1024)
 def _ensure_iso_date(value: str) -> str:
     try:
         return datetime.fromisoformat(value).isoformat()
@@ -24,7 +55,14 @@ def _ensure_iso_date(value: str) -> str:
         raise ValueError(f"Invalid ISO datetime: {value}")
 
 
+@lru_cache(maxsize=2048)
 def _ensure_date(value: str) -> str:
+    # Fast path for plain YYYY-MM-DD, skipping strptime and its ValueError on format misses
+    if len(value) == 10 and value[4] == "-" and value[7] == "-":
+        try:
+            return datetime.fromisoformat(value).date().isoformat()
+        except ValueError:
+            pass
     for fmt in ("%Y-%m-%d", "%Y-%m-%dT%H:%M:%S"):
         try:
             parsed = datetime.strptime(value, fmt)
@@ -34,26 +72,69 @@ def _ensure_date(value: str) -> str:
     raise ValueError(f"Invalid date string: {value}")
 
 
-def _load_sets(conn: sqlite3.Connection, exercise_id: int) -> list[dict[str, Any]]:
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM sets WHERE exercise_id = ? ORDER BY set_index", (exercise_id,))
-    return [_row_to_dict(row) for row in cursor.fetchall()]
+def _like_contains(text: str) -> str:
+    """A LIKE pattern matching text anywhere, with its wildcards escaped for ESCAPE '\\'."""
+    escaped = text.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    return f"%{escaped}%"
 
 
-def _hydrate_workout(conn: sqlite3.Connection, workout: dict[str, Any]) -> dict[str, Any]:
-    workout["tags"] = deserialize_tags(workout.get("tags"))
-    cursor = conn.cursor()
-    cursor.execute(
-        "SELECT * FROM exercises WHERE workout_id = ? ORDER BY order_index",
-        (workout["id"],),
-    )
-    exercises = []
-    for ex_row in cursor.fetchall():
-        ex = _row_to_dict(ex_row)
-        ex["sets"] = _load_sets(conn, ex["id"])
-        exercises.append(ex)
-    workout["exercises"] = exercises
-    return workout
+def _end_of_day(date: str) -> str:
+    """Exclusive upper bound for date_time values on a YYYY-MM-DD date.
+
+    '~' sorts after every character of an ISO time, so the bound is above any
+    'YYYY-MM-DDT...' on that day and below the next day, with no date arithmetic
+    (which would overflow for 9999-12-31).
+    """
+    return f"{date}~"
+
+
+def _id_list(ids: list[int]) -> str:
+    """Encode ids for an `IN (SELECT value FROM json_each(?))` filter.
+
+    A single JSON parameter keeps the SQL text constant and avoids the bound-parameter limit.
+    """
+    return json.dumps(ids)
+
+
+def _compile_filter_templates(conditions: tuple[str, ...], build: Callable[[str], str]) -> tuple[str, ...]:
+    """Render a query for every subset of conditions at import time.
+
+    The result is indexed by a bitmask of active conditions (bit i = conditions[i]),
+    so each call picks a fixed SQL string instead of concatenating one.
+    """
+    templates = []
+    for mask in range(1 << len(conditions)):
+        active = [condition for bit, condition in enumerate(conditions) if mask & (1 << bit)]
+        templates.append(build(" WHERE " + " AND ".join(active) if active else ""))
+    return tuple(templates)
+
+
+def _pick_template(templates: tuple[str, ...], values: tuple[Any, ...]) -> tuple[str, list[Any]]:
+    """Select the template for the truthy values and return it with their parameters."""
+    mask = 0
+    params: list[Any] = []
+    for bit, value in enumerate(values):
+        if value:
+            mask |= 1 << bit
+            params.append(value)
+    return templates[mask], params
+
+
+# Date-range filters shared by the nutrition day and body metrics queries
+_DATE_RANGE_FILTERS = ("date >= ?", "date <= ?")
+
+
+def _load_sets_by_exercise(conn: sqlite3.Connection, exercise_ids: list[int]) -> dict[int, list[dict[str, Any]]]:
+    sets_by_exercise: dict[int, list[dict[str, Any]]] = defaultdict(list)
+    if exercise_ids:
+        cursor = conn.execute(
+            f"SELECT {_SET_SELECT} FROM sets WHERE exercise_id IN (SELECT value FROM json_each(?)) "
+            "ORDER BY exercise_id, set_index",
+            (_id_list(exercise_ids),),
+        )
+        for set_row in _fetch_dicts(cursor):
+            sets_by_exercise[set_row["exercise_id"]].append(set_row)
+    return sets_by_exercise
 
 
 # ============================================================
@@ -61,6 +142,120 @@ def _hydrate_workout(conn: sqlite3.Connection, workout: dict[str, Any]) -> dict[
 # ============================================================
 
 
+_EXERCISE_COLUMNS = ("workout_id", "order_index", "name", "category", "notes")
+_SET_COLUMNS = (
+    "exercise_id", "set_index", "reps", "weight_kg", "weight_lbs",
+    "distance_m", "distance_yards", "duration_s",
+    "side", "rpe", "rir", "is_warmup",
+)
+_REAL_SET_COLUMNS = ("reps", "weight_kg", "weight_lbs", "distance_m", "distance_yards", "duration_s", "rpe", "rir")
+# Explicit select list for reading set rows back
+_SET_SELECT = ", ".join(("id", *_SET_COLUMNS))
+_INSERT_SET_SQL = f"INSERT INTO sets ({', '.join(_SET_COLUMNS)}) VALUES ({', '.join('?' * len(_SET_COLUMNS))})"
+
+# Nested workout -> exercises -> sets documents, serialized by SQLite. Subquery results
+# lose their JSON subtype, so they are re-wrapped with json() before being aggregated.
+_SET_JSON_SQL = "json_object(" + ", ".join(f"'{column}', sets.{column}" for column in ("id", *_SET_COLUMNS)) + ")"
+_EXERCISE_JSON_SQL = (
+    "json_object("
+    + ", ".join(f"'{column}', exercises.{column}" for column in ("id", *_EXERCISE_COLUMNS))
+    + ", 'sets', (SELECT json_group_array(json(set_json)) FROM ("
+    f"SELECT {_SET_JSON_SQL} AS set_json FROM sets WHERE sets.exercise_id = exercises.id ORDER BY sets.set_index)))"
+)
+_WORKOUT_JSON_SQL = (
+    "json_object('id', workouts.id, 'date_time', workouts.date_time, 'workout_type', workouts.workout_type, "
+    "'tags', CASE WHEN json_valid(workouts.tags) THEN json(workouts.tags) ELSE json_array() END, "
+    "'notes', workouts.notes, 'exercises', (SELECT json_group_array(json(exercise_json)) FROM ("
+    f"SELECT {_EXERCISE_JSON_SQL} AS exercise_json FROM exercises "
+    "WHERE exercises.workout_id = workouts.id ORDER BY exercises.order_index)))"
+)
+
+
+def _workouts_json_query(clauses: str) -> str:
+    """SQL returning the workouts selected by clauses (WHERE / ORDER BY / LIMIT) as one JSON array."""
+    return (
+        f"SELECT json_group_array(json(workout_json)) FROM "
+        f"(SELECT {_WORKOUT_JSON_SQL} AS workout_json FROM workouts{clauses})"
+    )
+
+
+def _select_workouts(conn: sqlite3.Connection, sql: str, params: list[Any]) -> list[dict[str, Any]]:
+    """Run a _workouts_json_query statement and parse its nested workouts."""
+    row = conn.execute(sql, params).fetchone()
+    return json.loads(row[0])
+
+
+# Stay under SQLite's historical default bound-parameter limit per statement
+_MAX_VARIABLES = 999
+
+
+def _insert_returning(
+    cursor: sqlite3.Cursor,
+    table: str,
+    columns: tuple[str, ...],
+    rows: list[tuple[Any, ...]],
+    real_columns: tuple[str, ...] = (),
+) -> list[dict[str, Any]]:
+    """Insert rows using multi-row VALUES statements and return the stored rows.
+
+    RETURNING reports integral values in REAL columns as ints (SQLite only converts
+    them back to floats on SELECT), so real_columns are coerced to match a re-read.
+    """
+    row_sql = "(" + ", ".join("?" * len(columns)) + ")"
+    per_statement = _MAX_VARIABLES // len(columns)
+    inserted: list[dict[str, Any]] = []
+    for start in range(0, len(rows), per_statement):
+        chunk = rows[start:start + per_statement]
+        cursor.execute(
+            f"INSERT INTO {table} ({', '.join(columns)}) VALUES {', '.join([row_sql] * len(chunk))} RETURNING *",
+            [value for row in chunk for value in row],
+        )
+        inserted.extend(_fetch_dicts(cursor))
+    for row in inserted:
+        for column in real_columns:
+            if type(row[column]) is int:
+                row[column] = float(row[column])
+    return inserted
+
+
+def _filtered_workouts_query(where: str, tail: str) -> str:
+    """Workouts JSON query for a filter template.
+
+    Tag filters are driven from workout_tags, whose (tag, date_time) index serves both
+    the match and the ordering; UNIQUE(workout_id, tag) keeps the join duplicate-free.
+    """
+    if _TAG_FILTER_SQL in where:
+        return _workouts_json_query(
+            f" JOIN workout_tags ON workout_tags.workout_id = workouts.id{where}"
+            f" ORDER BY workout_tags.date_time DESC{tail}"
+        )
+    return _workouts_json_query(f"{where} ORDER BY workouts.date_time DESC{tail}")
+
+
+# Exact (ASCII case-insensitive, via the column's NOCASE collation) tag match
+_TAG_FILTER_SQL = "workout_tags.tag = ?"
+
+# Case-insensitive substring match on exercise names; the pattern comes from _like_contains
+_EXERCISE_NAME_FILTER_SQL = (
+    "EXISTS (SELECT 1 FROM exercises WHERE exercises.workout_id = workouts.id AND exercises.name LIKE ? ESCAPE '\\')"
+)
+
+# Filters in bitmask order: from_date, to_date, workout_type, tag, exercise_name_contains
+_WORKOUT_FILTERS = (
+    "workouts.date_time >= ?", "workouts.date_time < ?", "workouts.workout_type = ?",
+    _TAG_FILTER_SQL, _EXERCISE_NAME_FILTER_SQL,
+)
+_GET_WORKOUTS_SQL = _compile_filter_templates(
+    _WORKOUT_FILTERS,
+    lambda where: _filtered_workouts_query(where, " LIMIT ? OFFSET ?"),
+)
+# workout_type, tag
+_LAST_WORKOUT_SQL = _compile_filter_templates(
+    _WORKOUT_FILTERS[2:4],
+    lambda where: _filtered_workouts_query(where, " LIMIT 1"),
+)
+
+
 def _parse_json_array(value: Any) -> Any:
     """Parse a JSON string into an array, or return the original value if not a string."""
     if isinstance(value, str):
@@ -73,7 +268,7 @@ def _parse_json_array(value: Any) -> Any:
     return value
 
 
-@app.tool()
+@_tool
 def log_workout(
     date_time: str,
     workout_type: Optional[str] = None,
@@ -109,60 +304,73 @@ def log_workout(
     date_time = _ensure_iso_date(date_time)
     tags_json = serialize_tags(tags)
 
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute(
-        "INSERT INTO workouts (date_time, workout_type, tags, notes) VALUES (?, ?, ?, ?)",
-        (date_time, workout_type, tags_json, notes),
-    )
-    workout_id = cursor.lastrowid
-
-    if exercises:
-        for order_index, exercise in enumerate(exercises, start=1):
-            exercise_name = exercise.get("name")
-            if not exercise_name:
-                raise ValueError(f"Exercise at index {order_index} is missing required 'name' field")
-            
-            cursor.execute(
-                "INSERT INTO exercises (workout_id, order_index, name, category, notes) VALUES (?, ?, ?, ?, ?)",
-                (workout_id, order_index, exercise_name, exercise.get("category"), exercise.get("notes")),
+    exercises = exercises or []
+    for order_index, exercise in enumerate(exercises, start=1):
+        if not exercise.get("name"):
+            raise ValueError(f"Exercise at index {order_index} is missing required 'name' field")
+
+    with transaction() as conn:
+        # Check the children's foreign keys once at COMMIT rather than per inserted row;
+        # SQLite resets the pragma when the transaction ends
+        conn.execute("PRAGMA defer_foreign_keys = ON")
+        cursor = conn.cursor()
+        cursor.execute(
+            "INSERT INTO workouts (date_time, workout_type, tags, notes) VALUES (?, ?, ?, ?) RETURNING *",
+            (date_time, workout_type, tags_json, notes),
+        )
+        workout = _row_to_dict(cursor.fetchone())
+        if tags:
+            cursor.executemany(
+                "INSERT OR IGNORE INTO workout_tags (workout_id, tag, date_time) VALUES (?, ?, ?)",
+                [(workout["id"], tag, date_time) for tag in tags if tag is not None],
             )
-            exercise_id = cursor.lastrowid
-
-            for set_index, set_payload in enumerate(exercise.get("sets", []), start=1):
-                cursor.execute(
-                    """INSERT INTO sets (
-                        exercise_id, set_index, reps, weight_kg, weight_lbs,
-                        distance_m, distance_yards, duration_s,
-                        side, rpe, rir, is_warmup
-                    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-                    (
-                        exercise_id,
-                        set_payload.get("set_index") or set_index,
-                        set_payload.get("reps"),
-                        set_payload.get("weight_kg"),
-                        set_payload.get("weight_lbs"),
-                        set_payload.get("distance_m"),
-                        set_payload.get("distance_yards"),
-                        set_payload.get("duration_s"),
-                        set_payload.get("side"),
-                        set_payload.get("rpe"),
-                        set_payload.get("rir"),
-                        1 if set_payload.get("is_warmup") else 0,
-                    ),
+
+        exercise_rows = _insert_returning(
+            cursor,
+            "exercises",
+            _EXERCISE_COLUMNS,
+            [
+                (workout["id"], order_index, exercise["name"], exercise.get("category"), exercise.get("notes"))
+                for order_index, exercise in enumerate(exercises, start=1)
+            ],
+        )
+        # RETURNING order is unspecified, so match rows back to the payload by order_index
+        exercise_rows.sort(key=lambda ex: ex["order_index"])
+
+        set_rows: list[tuple[Any, ...]] = []
+        for ex, exercise in zip(exercise_rows, exercises):
+            set_rows.extend(
+                (
+                    ex["id"],
+                    set_payload.get("set_index") or set_index,
+                    set_payload.get("reps"),
+                    set_payload.get("weight_kg"),
+                    set_payload.get("weight_lbs"),
+                    set_payload.get("distance_m"),
+                    set_payload.get("distance_yards"),
+                    set_payload.get("duration_s"),
+                    set_payload.get("side"),
+                    set_payload.get("rpe"),
+                    set_payload.get("rir"),
+                    bool(set_payload.get("is_warmup")),
                 )
+                for set_index, set_payload in enumerate(exercise.get("sets", []), start=1)
+            )
+        sets = _insert_returning(cursor, "sets", _SET_COLUMNS, set_rows, _REAL_SET_COLUMNS)
 
-    conn.commit()
-    
-    # Return the fully hydrated workout for confirmation
-    workout = cursor.execute("SELECT * FROM workouts WHERE id = ?", (workout_id,)).fetchone()
-    result = _hydrate_workout(conn, _row_to_dict(workout))
-    
-    conn.close()
-    return result
+    # Build the confirmation payload from the RETURNING rows instead of re-reading the workout
+    sets_by_exercise: dict[int, list[dict[str, Any]]] = defaultdict(list)
+    for set_row in sorted(sets, key=lambda st: st["set_index"]):
+        sets_by_exercise[set_row["exercise_id"]].append(set_row)
+    for ex in exercise_rows:
+        ex["sets"] = sets_by_exercise[ex["id"]]
+
+    workout["tags"] = deserialize_tags(workout["tags"])
+    workout["exercises"] = exercise_rows
+    return workout
 
 
-@app.tool()
+@_tool
 def add_exercise(
     workout_id: int,
     name: str,
@@ -177,24 +385,21 @@ def add_exercise(
         category: Optional category (e.g., 'Squat', 'Push', 'Pull')
         notes: Optional notes about the exercise
     """
-    conn = get_connection()
-    cursor = conn.cursor()
-    
-    # Get current max order_index
-    cursor.execute("SELECT COALESCE(MAX(order_index), 0) FROM exercises WHERE workout_id = ?", (workout_id,))
-    max_order = cursor.fetchone()[0]
-    
-    cursor.execute(
-        "INSERT INTO exercises (workout_id, order_index, name, category, notes) VALUES (?, ?, ?, ?, ?)",
-        (workout_id, max_order + 1, name, category, notes),
-    )
-    exercise_id = cursor.lastrowid
-    conn.commit()
-    conn.close()
-    return {"exercise_id": exercise_id}
+    with transaction() as conn:
+        cursor = conn.cursor()
 
+        # Get current max order_index
+        cursor.execute("SELECT COALESCE(MAX(order_index), 0) FROM exercises WHERE workout_id = ?", (workout_id,))
+        max_order = cursor.fetchone()[0]
 
-@app.tool()
+        cursor.execute(
+            "INSERT INTO exercises (workout_id, order_index, name, category, notes) VALUES (?, ?, ?, ?, ?)",
+            (workout_id, max_order + 1, name, category, notes),
+        )
+        return {"exercise_id": cursor.lastrowid}
+
+
+@_tool
 def add_set(
     exercise_id: int,
     reps: Optional[float] = None,
@@ -223,30 +428,24 @@ def add_set(
         rir: Reps In Reserve (0-5)
         is_warmup: Whether this is a warmup set
     """
-    conn = get_connection()
-    cursor = conn.cursor()
-    
-    # Get current max set_index
-    cursor.execute("SELECT COALESCE(MAX(set_index), 0) FROM sets WHERE exercise_id = ?", (exercise_id,))
-    max_set = cursor.fetchone()[0]
-    
-    cursor.execute(
-        """INSERT INTO sets (
-            exercise_id, set_index, reps, weight_kg, weight_lbs,
-            distance_m, distance_yards, duration_s, side, rpe, rir, is_warmup
-        ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-        (
-            exercise_id, max_set + 1, reps, weight_kg, weight_lbs,
-            distance_m, distance_yards, duration_s, side, rpe, rir, 1 if is_warmup else 0
-        ),
-    )
-    set_id = cursor.lastrowid
-    conn.commit()
-    conn.close()
-    return {"set_id": set_id}
+    with transaction() as conn:
+        cursor = conn.cursor()
+
+        # Get current max set_index
+        cursor.execute("SELECT COALESCE(MAX(set_index), 0) FROM sets WHERE exercise_id = ?", (exercise_id,))
+        max_set = cursor.fetchone()[0]
+
+        cursor.execute(
+            _INSERT_SET_SQL,
+            (
+                exercise_id, max_set + 1, reps, weight_kg, weight_lbs,
+                distance_m, distance_yards, duration_s, side, rpe, rir, is_warmup,
+            ),
+        )
+        return {"set_id": cursor.lastrowid}
 
 
-@app.tool()
+@_tool
 def get_workouts(
     from_date: Optional[str] = None,
     to_date: Optional[str] = None,
@@ -257,40 +456,24 @@ def get_workouts(
     offset: int = 0,
 ) -> dict[str, list[dict[str, Any]]]:
     """Query workouts with various filters."""
-    conn = get_connection()
-    cursor = conn.cursor()
-
-    filters: list[str] = []
-    params: list[Any] = []
-
-    if from_date:
-        filters.append("date_time >= ?")
-        params.append(f"{_ensure_date(from_date)}T00:00:00")
-    if to_date:
-        filters.append("date_time <= ?")
-        params.append(f"{_ensure_date(to_date)}T23:59:59")
-    if workout_type:
-        filters.append("workout_type = ?")
-        params.append(workout_type)
-    if tag:
-        filters.append("tags LIKE ?")
-        params.append(f'%"{tag}"%')
-
-    base = "SELECT * FROM workouts"
-    if filters:
-        base += " WHERE " + " AND ".join(filters)
-    base += " ORDER BY date_time DESC LIMIT ? OFFSET ?"
+    sql, params = _pick_template(
+        _GET_WORKOUTS_SQL,
+        (
+            from_date and _ensure_date(from_date),
+            to_date and _end_of_day(_ensure_date(to_date)),
+            workout_type,
+            tag,
+            exercise_name_contains and _like_contains(exercise_name_contains),
+        ),
+    )
     params.extend([limit, offset])
 
-    cursor.execute(base, params)
-    rows = cursor.fetchall()
-
-    workouts = [_hydrate_workout(conn, _row_to_dict(row)) for row in rows]
-    conn.close()
+    with connection() as conn:
+        workouts = _select_workouts(conn, sql, params)
     return {"workouts": workouts}
 
 
-@app.tool()
+@_tool
 def get_last_workout(
     workout_type: Optional[str] = None,
     tag: Optional[str] = None,
@@ -299,35 +482,14 @@ def get_last_workout(
     if not workout_type and not tag:
         raise ValueError("At least one of workout_type or tag is required")
 
-    conn = get_connection()
-    cursor = conn.cursor()
+    sql, params = _pick_template(_LAST_WORKOUT_SQL, (workout_type, tag))
 
-    filters: list[str] = []
-    params: list[Any] = []
-    if workout_type:
-        filters.append("workout_type = ?")
-        params.append(workout_type)
-    if tag:
-        filters.append("tags LIKE ?")
-        params.append(f'%"{tag}"%')
-
-    base = "SELECT * FROM workouts"
-    if filters:
-        base += " WHERE " + " AND ".join(filters)
-    base += " ORDER BY date_time DESC LIMIT 1"
-
-    cursor.execute(base, params)
-    row = cursor.fetchone()
-    if not row:
-        conn.close()
-        return {"workout": None}
-
-    workout = _hydrate_workout(conn, _row_to_dict(row))
-    conn.close()
-    return {"workout": workout}
-
-
-@app.tool()
+    with connection() as conn:
+        workouts = _select_workouts(conn, sql, params)
+    return {"workout": workouts[0] if workouts else None}
+
+
+@_tool
 def get_exercise_history(
     exercise_name: str,
     from_date: Optional[str] = None,
@@ -335,39 +497,35 @@ def get_exercise_history(
     limit: int = 20,
 ) -> dict[str, list[dict[str, Any]]]:
     """Get history of a specific exercise across workouts."""
-    conn = get_connection()
-    cursor = conn.cursor()
-
     base = """
     SELECT w.id as workout_id, w.date_time, w.workout_type, w.tags, w.notes as workout_notes,
            e.id as exercise_id, e.name as exercise_name, e.category as exercise_category, e.notes as exercise_notes
     FROM workouts w
     JOIN exercises e ON e.workout_id = w.id
-    WHERE LOWER(e.name) = LOWER(?)
+    WHERE e.name = ? COLLATE NOCASE
     """
     params: list[Any] = [exercise_name]
 
     if from_date:
         base += " AND w.date_time >= ?"
-        params.append(f"{_ensure_date(from_date)}T00:00:00")
+        params.append(_ensure_date(from_date))
     if to_date:
-        base += " AND w.date_time <= ?"
-        params.append(f"{_ensure_date(to_date)}T23:59:59")
+        base += " AND w.date_time < ?"
+        params.append(_end_of_day(_ensure_date(to_date)))
 
     base += " ORDER BY w.date_time DESC LIMIT ?"
     params.append(limit)
 
-    cursor.execute(base, params)
-    rows = cursor.fetchall()
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(base, params)
+        entries = _fetch_dicts(cursor)
+        sets_by_exercise = _load_sets_by_exercise(conn, [item["exercise_id"] for item in entries])
 
-    entries: list[dict[str, Any]] = []
-    for row in rows:
-        item = _row_to_dict(row)
-        item["tags"] = deserialize_tags(item["tags"])
-        item["sets"] = _load_sets(conn, item["exercise_id"])
-        entries.append(item)
+        for item in entries:
+            item["tags"] = deserialize_tags(item["tags"])
+            item["sets"] = sets_by_exercise[item["exercise_id"]]
 
-    conn.close()
     return {"entries": entries}
 
 
@@ -376,50 +534,68 @@ def get_exercise_history(
 # ============================================================
 
 
-@app.tool()
+_MACROS = ("calories", "protein_g", "carbs_g", "fats_g", "fiber_g")
+# Summed inside SQLite; COALESCE keeps the old `0` for groups without items
+_MACRO_TOTALS_SQL = ", ".join(f"COALESCE(SUM({macro}), 0) AS {macro}" for macro in _MACROS)
+
+
+_NUTRITION_DAYS_SQL = _compile_filter_templates(
+    _DATE_RANGE_FILTERS, lambda where: f"SELECT * FROM nutrition_days{where} ORDER BY date DESC LIMIT ? OFFSET ?"
+)
+
+
+def _upsert_day_id(cursor: sqlite3.Cursor, date: str) -> int:
+    """Return the id of the nutrition day for date, creating the day if needed."""
+    cursor.execute(
+        "INSERT INTO nutrition_days (date) VALUES (?) ON CONFLICT(date) DO UPDATE SET date = excluded.date RETURNING id",
+        (date,),
+    )
+    return cursor.fetchone()[0]
+
+
+def _totals(row: sqlite3.Row | None) -> dict[str, float]:
+    if row is None:
+        return dict.fromkeys(_MACROS, 0)
+    return {macro: row[macro] for macro in _MACROS}
+
+
+@_tool
 def upsert_nutrition_day(date: str, notes: Optional[str] = None) -> dict[str, int]:
     """Create or update a nutrition day entry."""
     date = _ensure_date(date)
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute(
-        "INSERT INTO nutrition_days (date, notes) VALUES (?, ?) ON CONFLICT(date) DO UPDATE SET notes = ?",
-        (date, notes, notes),
-    )
-    day_id = cursor.lastrowid or cursor.execute("SELECT id FROM nutrition_days WHERE date = ?", (date,)).fetchone()[0]
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        cursor = conn.cursor()
+        # RETURNING yields the id whether the row was inserted or updated
+        cursor.execute(
+            """INSERT INTO nutrition_days (date, notes) VALUES (?, ?)
+               ON CONFLICT(date) DO UPDATE SET notes = excluded.notes RETURNING id""",
+            (date, notes),
+        )
+        day_id = cursor.fetchone()[0]
     return {"day_id": day_id}
 
 
-@app.tool()
+@_tool
 def upsert_meal(date: str, name: str, order_index: int = 0) -> dict[str, int]:
     """Create or update a meal within a nutrition day."""
     date = _ensure_date(date)
-    conn = get_connection()
-    cursor = conn.cursor()
+    with transaction() as conn:
+        cursor = conn.cursor()
 
-    # Ensure day exists
-    cursor.execute("INSERT OR IGNORE INTO nutrition_days (date) VALUES (?)", (date,))
-    cursor.execute("SELECT id FROM nutrition_days WHERE date = ?", (date,))
-    day_id = cursor.fetchone()[0]
+        day_id = _upsert_day_id(cursor, date)
 
-    # Upsert meal
-    cursor.execute(
-        """INSERT INTO meals (day_id, name, order_index) VALUES (?, ?, ?)
-           ON CONFLICT(day_id, name) DO UPDATE SET order_index = ?""",
-        (day_id, name, order_index, order_index),
-    )
-    meal_id = cursor.lastrowid or cursor.execute(
-        "SELECT id FROM meals WHERE day_id = ? AND name = ?", (day_id, name)
-    ).fetchone()[0]
+        # Upsert meal
+        cursor.execute(
+            """INSERT INTO meals (day_id, name, order_index) VALUES (?, ?, ?)
+               ON CONFLICT(day_id, name) DO UPDATE SET order_index = excluded.order_index RETURNING id""",
+            (day_id, name, order_index),
+        )
+        meal_id = cursor.fetchone()[0]
 
-    conn.commit()
-    conn.close()
     return {"meal_id": meal_id}
 
 
-@app.tool()
+@_tool
 def add_or_update_meal_item(
     date: str,
     meal_name: str,
@@ -443,100 +619,104 @@ def add_or_update_meal_item(
     then call this tool with the calculated values for the serving quantity.
     """
     date = _ensure_date(date)
-    conn = get_connection()
-    cursor = conn.cursor()
+    with transaction() as conn:
+        cursor = conn.cursor()
 
-    # Ensure day and meal exist
-    cursor.execute("INSERT OR IGNORE INTO nutrition_days (date) VALUES (?)", (date,))
-    cursor.execute("SELECT id FROM nutrition_days WHERE date = ?", (date,))
-    day_id = cursor.fetchone()[0]
-
-    cursor.execute(
-        "INSERT OR IGNORE INTO meals (day_id, name, order_index) VALUES (?, ?, 0)",
-        (day_id, meal_name),
-    )
-    cursor.execute("SELECT id FROM meals WHERE day_id = ? AND name = ?", (day_id, meal_name))
-    meal_id = cursor.fetchone()[0]
-
-    if item_id:
-        # Update existing item
+        # Ensure day and meal exist; an existing meal keeps its order_index
+        day_id = _upsert_day_id(cursor, date)
         cursor.execute(
-            """UPDATE meal_items SET
-               food_id=?, food_name=?, brand_name=?, serving_quantity=?, serving_unit=?,
-               grams=?, calories=?, protein_g=?, carbs_g=?, fats_g=?, fiber_g=?, notes=?
-               WHERE id=?""",
-            (
-                food_id, food_name, brand_name, serving_quantity, serving_unit,
-                grams, calories, protein_g, carbs_g, fats_g, fiber_g, notes, item_id,
-            ),
+            """INSERT INTO meals (day_id, name, order_index) VALUES (?, ?, 0)
+               ON CONFLICT(day_id, name) DO UPDATE SET name = excluded.name RETURNING id""",
+            (day_id, meal_name),
         )
-    else:
-        # Insert new item
-        cursor.execute(
-            """INSERT INTO meal_items (
-               meal_id, food_id, food_name, brand_name, serving_quantity, serving_unit,
-               grams, calories, protein_g, carbs_g, fats_g, fiber_g, notes
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-            (
-                meal_id, food_id, food_name, brand_name, serving_quantity, serving_unit,
-                grams, calories, protein_g, carbs_g, fats_g, fiber_g, notes,
-            ),
-        )
-        item_id = cursor.lastrowid
+        meal_id = cursor.fetchone()[0]
+
+        if item_id:
+            # Update existing item
+            cursor.execute(
+                """UPDATE meal_items SET
+                   food_id=?, food_name=?, brand_name=?, serving_quantity=?, serving_unit=?,
+                   grams=?, calories=?, protein_g=?, carbs_g=?, fats_g=?, fiber_g=?, notes=?
+                   WHERE id=?""",
+                (
+                    food_id, food_name, brand_name, serving_quantity, serving_unit,
+                    grams, calories, protein_g, carbs_g, fats_g, fiber_g, notes, item_id,
+                ),
+            )
+        else:
+            # Insert new item
+            cursor.execute(
+                """INSERT INTO meal_items (
+                   meal_id, food_id, food_name, brand_name, serving_quantity, serving_unit,
+                   grams, calories, protein_g, carbs_g, fats_g, fiber_g, notes
+                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+                (
+                    meal_id, food_id, food_name, brand_name, serving_quantity, serving_unit,
+                    grams, calories, protein_g, carbs_g, fats_g, fiber_g, notes,
+                ),
+            )
+            item_id = cursor.lastrowid
 
-    conn.commit()
-    conn.close()
     return {"item_id": item_id, "meal_id": meal_id, "day_id": day_id}
 
 
-@app.tool()
-def get_nutrition_day(date: str) -> dict[str, Any | None]:
-    """Get a complete nutrition day with meals and items."""
+@_tool
+def get_nutrition_day(date: str, include_items: bool = True) -> dict[str, Any | None]:
+    """Get a complete nutrition day with meals, items, and totals.
+
+    Args:
+        date: Date in YYYY-MM-DD format
+        include_items: Set to False to return only meal and day totals without the food items
+    """
     date = _ensure_date(date)
-    conn = get_connection()
-    cursor = conn.cursor()
-
-    cursor.execute("SELECT * FROM nutrition_days WHERE date = ?", (date,))
-    day_row = cursor.fetchone()
-    if not day_row:
-        conn.close()
-        return {"day": None}
-
-    day = _row_to_dict(day_row)
-    cursor.execute("SELECT * FROM meals WHERE day_id = ? ORDER BY order_index", (day["id"],))
-
-    meals = []
-    for meal_row in cursor.fetchall():
-        meal = _row_to_dict(meal_row)
-        cursor.execute("SELECT * FROM meal_items WHERE meal_id = ?", (meal["id"],))
-        items = [_row_to_dict(r) for r in cursor.fetchall()]
-
-        # Compute totals
-        totals = {
-            "calories": sum(i["calories"] for i in items),
-            "protein_g": sum(i["protein_g"] for i in items),
-            "carbs_g": sum(i["carbs_g"] for i in items),
-            "fats_g": sum(i["fats_g"] for i in items),
-            "fiber_g": sum(i["fiber_g"] for i in items),
-        }
-        meal["items"] = items
-        meal["totals"] = totals
-        meals.append(meal)
-
-    # Compute day totals
-    day["totals"] = {
-        "calories": sum(m["totals"]["calories"] for m in meals),
-        "protein_g": sum(m["totals"]["protein_g"] for m in meals),
-        "carbs_g": sum(m["totals"]["carbs_g"] for m in meals),
-        "fats_g": sum(m["totals"]["fats_g"] for m in meals),
-        "fiber_g": sum(m["totals"]["fiber_g"] for m in meals),
-    }
+    with connection() as conn:
+        cursor = conn.cursor()
+
+        cursor.execute("SELECT * FROM nutrition_days WHERE date = ?", (date,))
+        day_row = cursor.fetchone()
+        if not day_row:
+            return {"day": None}
+
+        day = _row_to_dict(day_row)
+        cursor.execute("SELECT * FROM meals WHERE day_id = ? ORDER BY order_index", (day["id"],))
+        meals = _fetch_dicts(cursor)
+
+        # Meal totals are aggregated by SQLite; the day totals are accumulated from
+        # them in the same pass instead of a second query over the items
+        cursor.execute(
+            f"""SELECT meal_id, {_MACRO_TOTALS_SQL} FROM meal_items
+                WHERE meal_id IN (SELECT id FROM meals WHERE day_id = ?)
+                GROUP BY meal_id""",
+            (day["id"],),
+        )
+        totals_by_meal: dict[int, dict[str, float]] = {}
+        day_totals = _totals(None)
+        for row in cursor.fetchall():
+            meal_totals = totals_by_meal[row["meal_id"]] = _totals(row)
+            for macro in _MACROS:
+                day_totals[macro] += meal_totals[macro]
+        day["totals"] = day_totals
+
+        items_by_meal: dict[int, list[dict[str, Any]]] = defaultdict(list)
+        if include_items:
+            # One query for the whole day, bucketed per meal
+            cursor.execute(
+                "SELECT * FROM meal_items WHERE meal_id IN (SELECT id FROM meals WHERE day_id = ?) ORDER BY meal_id, id",
+                (day["id"],),
+            )
+            for item in _fetch_dicts(cursor):
+                items_by_meal[item["meal_id"]].append(item)
+
+        for meal in meals:
+            if include_items:
+                meal["items"] = items_by_meal[meal["id"]]
+            meal["totals"] = totals_by_meal.get(meal["id"]) or _totals(None)
+
     day["meals"] = meals
-    conn.close()
     return {"day": day}
 
 
-@app.tool()
+@_tool
 def get_nutrition_days_summary(
     from_date: Optional[str] = None,
     to_date: Optional[str] = None,
@@ -544,88 +724,70 @@ def get_nutrition_days_summary(
     offset: int = 0,
 ) -> dict[str, list[dict[str, Any]]]:
     """Get nutrition summaries for a date range."""
-    conn = get_connection()
-    cursor = conn.cursor()
+    sql, params = _pick_template(
+        _NUTRITION_DAYS_SQL,
+        (from_date and _ensure_date(from_date), to_date and _ensure_date(to_date)),
+    )
+    params.extend([limit, offset])
 
-    filters = []
-    params = []
-    if from_date:
-        filters.append("date >= ?")
-        params.append(_ensure_date(from_date))
-    if to_date:
-        filters.append("date <= ?")
-        params.append(_ensure_date(to_date))
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(sql, params)
+        days = _fetch_dicts(cursor)
 
-    base = "SELECT * FROM nutrition_days"
-    if filters:
-        base += " WHERE " + " AND ".join(filters)
-    base += " ORDER BY date DESC LIMIT ? OFFSET ?"
-    params.extend([limit, offset])
+        # Aggregate the items of every day on the page in one query
+        totals_by_day: dict[int, dict[str, float]] = {}
+        if days:
+            cursor.execute(
+                f"""SELECT m.day_id, {_MACRO_TOTALS_SQL}
+                    FROM meals m JOIN meal_items i ON i.meal_id = m.id
+                    WHERE m.day_id IN (SELECT value FROM json_each(?))
+                    GROUP BY m.day_id""",
+                (_id_list([day["id"] for day in days]),),
+            )
+            totals_by_day = {row["day_id"]: _totals(row) for row in cursor.fetchall()}
+
+        for day in days:
+            day["totals"] = totals_by_day.get(day["id"]) or _totals(None)
 
-    cursor.execute(base, params)
-    days = []
-    for row in cursor.fetchall():
-        day = _row_to_dict(row)
-        cursor.execute("SELECT * FROM meals WHERE day_id = ?", (day["id"],))
-        meals = cursor.fetchall()
-        items = []
-        for m in meals:
-            cursor.execute("SELECT * FROM meal_items WHERE meal_id = ?", (m["id"],))
-            items.extend(cursor.fetchall())
-        day["totals"] = {
-            "calories": sum(i["calories"] for i in items) if items else 0,
-            "protein_g": sum(i["protein_g"] for i in items) if items else 0,
-            "carbs_g": sum(i["carbs_g"] for i in items) if items else 0,
-            "fats_g": sum(i["fats_g"] for i in items) if items else 0,
-            "fiber_g": sum(i["fiber_g"] for i in items) if items else 0,
-        }
-        days.append(day)
-
-    conn.close()
     return {"days": days}
 
 
-@app.tool()
+@_tool
 def delete_meal_item(item_id: int) -> dict[str, bool]:
     """Delete a meal item."""
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM meal_items WHERE id = ?", (item_id,))
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM meal_items WHERE id = ?", (item_id,))
     return {"deleted": cursor.rowcount > 0}
 
 
-@app.tool()
+@_tool
 def delete_meal(meal_id: int, delete_items: bool = True) -> dict[str, bool]:
     """Delete a meal and optionally its items."""
-    conn = get_connection()
-    cursor = conn.cursor()
-    if delete_items:
-        cursor.execute("DELETE FROM meal_items WHERE meal_id = ?", (meal_id,))
-    cursor.execute("DELETE FROM meals WHERE id = ?", (meal_id,))
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        cursor = conn.cursor()
+        if delete_items:
+            cursor.execute("DELETE FROM meal_items WHERE meal_id = ?", (meal_id,))
+        cursor.execute("DELETE FROM meals WHERE id = ?", (meal_id,))
     return {"deleted": cursor.rowcount > 0}
 
 
-@app.tool()
+@_tool
 def delete_nutrition_day(date: str, cascade: bool = True) -> dict[str, bool]:
     """Delete a nutrition day and optionally cascade to meals/items."""
     date = _ensure_date(date)
-    conn = get_connection()
-    cursor = conn.cursor()
-    if cascade:
-        # Get meal IDs first
-        cursor.execute("SELECT id FROM meals WHERE day_id IN (SELECT id FROM nutrition_days WHERE date = ?)", (date,))
-        meal_ids = [r[0] for r in cursor.fetchall()]
-        if meal_ids:
-            placeholders = ",".join("?" * len(meal_ids))
-            cursor.execute(f"DELETE FROM meal_items WHERE meal_id IN ({placeholders})", meal_ids)
-        cursor.execute("DELETE FROM meals WHERE day_id IN (SELECT id FROM nutrition_days WHERE date = ?)", (date,))
-    cursor.execute("DELETE FROM nutrition_days WHERE date = ?", (date,))
-    conn.commit()
-    conn.close()
+    with transaction() as conn:
+        cursor = conn.cursor()
+        if cascade:
+            # Get meal IDs first
+            cursor.execute("SELECT id FROM meals WHERE day_id IN (SELECT id FROM nutrition_days WHERE date = ?)", (date,))
+            meal_ids = [r[0] for r in cursor.fetchall()]
+            if meal_ids:
+                placeholders = ",".join("?" * len(meal_ids))
+                cursor.execute(f"DELETE FROM meal_items WHERE meal_id IN ({placeholders})", meal_ids)
+            cursor.execute("DELETE FROM meals WHERE day_id IN (SELECT id FROM nutrition_days WHERE date = ?)", (date,))
+        cursor.execute("DELETE FROM nutrition_days WHERE date = ?", (date,))
     return {"deleted": cursor.rowcount > 0}
 
 
@@ -634,7 +796,12 @@ def delete_nutrition_day(date: str, cascade: bool = True) -> dict[str, bool]:
 # ============================================================
 
 
-@app.tool()
+_BODY_METRICS_SQL = _compile_filter_templates(
+    _DATE_RANGE_FILTERS, lambda where: f"SELECT * FROM body_metrics{where} ORDER BY date DESC LIMIT ? OFFSET ?"
+)
+
+
+@_tool
 def log_body_metrics(
     date: str,
     body_weight_kg: Optional[float] = None,
@@ -658,28 +825,25 @@ def log_body_metrics(
         Multiple sites: {"chest": 12, "abdomen": 18, "thigh": 15}
     """
     date = _ensure_date(date)
-    conn = get_connection()
-    cursor = conn.cursor()
+    with transaction() as conn:
+        cursor = conn.cursor()
 
-    cursor.execute(
-        "INSERT INTO body_metrics (date, body_weight_kg, notes) VALUES (?, ?, ?)",
-        (date, body_weight_kg, notes),
-    )
-    metrics_id = cursor.lastrowid
+        cursor.execute(
+            "INSERT INTO body_metrics (date, body_weight_kg, notes) VALUES (?, ?, ?)",
+            (date, body_weight_kg, notes),
+        )
+        metrics_id = cursor.lastrowid
 
-    if skinfolds:
-        for site, mm in skinfolds.items():
-            cursor.execute(
+        if skinfolds:
+            cursor.executemany(
                 "INSERT INTO skinfolds (body_metrics_id, site_name, mm) VALUES (?, ?, ?)",
-                (metrics_id, site, mm),
+                [(metrics_id, site, mm) for site, mm in skinfolds.items()],
             )
 
-    conn.commit()
-    conn.close()
     return {"body_metrics_id": metrics_id}
 
 
-@app.tool()
+@_tool
 def get_body_metrics(
     from_date: Optional[str] = None,
     to_date: Optional[str] = None,
@@ -687,34 +851,30 @@ def get_body_metrics(
     offset: int = 0,
 ) -> dict[str, list[dict[str, Any]]]:
     """Get body metrics with skinfolds."""
-    conn = get_connection()
-    cursor = conn.cursor()
-
-    filters = []
-    params = []
-    if from_date:
-        filters.append("date >= ?")
-        params.append(_ensure_date(from_date))
-    if to_date:
-        filters.append("date <= ?")
-        params.append(_ensure_date(to_date))
-
-    base = "SELECT * FROM body_metrics"
-    if filters:
-        base += " WHERE " + " AND ".join(filters)
-    base += " ORDER BY date DESC LIMIT ? OFFSET ?"
+    sql, params = _pick_template(
+        _BODY_METRICS_SQL,
+        (from_date and _ensure_date(from_date), to_date and _ensure_date(to_date)),
+    )
     params.extend([limit, offset])
 
-    cursor.execute(base, params)
-    metrics_list = []
-    for row in cursor.fetchall():
-        metrics = _row_to_dict(row)
-        cursor.execute("SELECT site_name, mm FROM skinfolds WHERE body_metrics_id = ?", (metrics["id"],))
-        skinfolds = {r["site_name"]: r["mm"] for r in cursor.fetchall()}
-        metrics["skinfolds"] = skinfolds
-        metrics_list.append(metrics)
+    with connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(sql, params)
+        metrics_list = _fetch_dicts(cursor)
+
+        # One query for the whole page; id order keeps the last duplicate site winning
+        skinfolds_by_metrics: dict[int, dict[str, float]] = defaultdict(dict)
+        if metrics_list:
+            cursor.execute(
+                "SELECT body_metrics_id, site_name, mm FROM skinfolds "
+                "WHERE body_metrics_id IN (SELECT value FROM json_each(?)) ORDER BY body_metrics_id, id",
+                (_id_list([metrics["id"] for metrics in metrics_list]),),
+            )
+            for body_metrics_id, site_name, mm in cursor:
+                skinfolds_by_metrics[body_metrics_id][site_name] = mm
+        for metrics in metrics_list:
+            metrics["skinfolds"] = skinfolds_by_metrics.get(metrics["id"], {})
 
-    conn.close()
     return {"metrics": metrics_list}
 
 
@@ -723,80 +883,253 @@ def get_body_metrics(
 # ============================================================
 
 
-@app.tool()
+def _fts_phrase(query: str) -> str:
+    """Quote query as a single FTS5 phrase so punctuation and operators are matched literally."""
+    return '"' + query.replace('"', '""') + '"'
+
+
+# Trigram indexes already match substrings, so prefix mode leaves their phrase as is
+_TRIGRAM_INDEXES = frozenset(fts for fts, (_, _, options) in FTS_TABLES.items() if "trigram" in options)
+
+
+# search_logs domains in result order: (domain, table, date column, table columns, FTS indexes).
+# The first index ranks matches by BM25; rows found only through the others rank after them.
+_SEARCH_DOMAINS = (
+    (
+        "workout", "workouts", "date_time", ("id", "date_time", "workout_type", "tags", "notes"),
+        ("workouts_fts", "workouts_tags_fts"),
+    ),
+    ("nutrition", "nutrition_days", "date", ("id", "date", "notes"), ("nutrition_days_fts",)),
+    ("body", "body_metrics", "date", ("id", "date", "body_weight_kg", "notes"), ("body_metrics_fts",)),
+)
+# Every domain's columns, NULL-padded per branch so the UNION ALL arms line up
+_SEARCH_COLUMNS = tuple(dict.fromkeys(column for _, _, _, columns, _ in _SEARCH_DOMAINS for column in columns))
+_SEARCH_DOMAIN_NAMES = frozenset(domain for domain, *_ in _SEARCH_DOMAINS)
+# Every non-empty domain subset in result order, looked up by its set of names
+_SEARCH_SUBSETS = {
+    frozenset(subset): subset
+    for size in range(1, len(_SEARCH_DOMAINS) + 1)
+    for subset in combinations([domain for domain, *_ in _SEARCH_DOMAINS], size)
+}
+# The date column and FTS indexes of each arm in a subset's statement, in parameter order
+_SEARCH_ARMS = {
+    subset: tuple((date_column, indexes) for domain, _, date_column, _, indexes in _SEARCH_DOMAINS if domain in subset)
+    for subset in _SEARCH_SUBSETS.values()
+}
+
+
+def _search_date_filters(table: str, date_column: str, has_from: bool, has_to: bool) -> list[str]:
+    filters = []
+    if has_from:
+        filters.append(f"{table}.{date_column} >= ?")
+    if has_to:
+        # date_time is bounded by _end_of_day; plain dates compare inclusively
+        filters.append(f"{table}.{date_column} {'<' if date_column == 'date_time' else '<='} ?")
+    return filters
+
+
+def _search_sql(domains: tuple[str, ...], has_query: bool, has_from: bool, has_to: bool) -> str:
+    """One UNION ALL statement searching the given domains.
+
+    Matches come from each domain's FTS5 indexes. A blank query cannot be expressed as
+    a MATCH, so it lists rows newest first instead. Each arm takes one query parameter per
+    index, then the from and to bounds and limit, followed by the overall
+    limit; SQLite stops reading arms once that many rows have been produced.
+    """
+    arms = []
+    for domain, table, date_column, columns, indexes in _SEARCH_DOMAINS:
+        if domain not in domains:
+            continue
+        filters = _search_date_filters(table, date_column, has_from, has_to)
+        where = " WHERE " + " AND ".join(filters) if filters else ""
+        select = ", ".join(
+            f"{table}.{column}" if column in columns else f"NULL AS {column}" for column in _SEARCH_COLUMNS
+        )
+        if has_query:
+            matches = " UNION ALL ".join(
+                f"SELECT rowid AS id, {f'bm25({fts})' if rank == 0 else '0.0'} AS score FROM {fts} WHERE {fts} MATCH ?"
+                for rank, fts in enumerate(indexes)
+            )
+            source = f"({matches}) AS matches JOIN {table} ON {table}.id = matches.id"
+            if len(indexes) > 1:
+                # A row matched by several indexes keeps its best score
+                order_by = f" GROUP BY {table}.id ORDER BY MIN(matches.score)"
+            else:
+                order_by = " ORDER BY matches.score"
+        else:
+            # Nothing to rank: list the newest rows, walking the date index so the scan
+            # stops after limit rows instead of reading the whole table
+            source, order_by = table, f" ORDER BY {table}.{date_column} DESC"
+        # Workout documents are built in the outer select, so only for rows that are returned.
+        # The hits are aliased as the table for _WORKOUT_JSON_SQL's column references.
+        document = _WORKOUT_JSON_SQL if domain == "workout" else "NULL"
+        arms.append(
+            f"SELECT domain, {', '.join(_SEARCH_COLUMNS)}, {document} AS document FROM "
+            f"(SELECT '{domain}' AS domain, {select} FROM {source}{where}{order_by} LIMIT ?) AS {table}"
+        )
+    return " UNION ALL ".join(arms) + " LIMIT ?"
+
+
+def _search_count_sql(domains: tuple[str, ...], has_query: bool, has_from: bool, has_to: bool) -> str:
+    """One UNION ALL statement counting each domain's matches without building any results.
+
+    Takes the same parameters as _search_sql minus the limits.
+    """
+    arms = []
+    for domain, table, date_column, _, indexes in _SEARCH_DOMAINS:
+        if domain not in domains:
+            continue
+        filters = _search_date_filters(table, date_column, has_from, has_to)
+        if has_query:
+            # UNION rather than UNION ALL: a row matched by several indexes counts once
+            matches = " UNION ".join(f"SELECT rowid FROM {fts} WHERE {fts} MATCH ?" for fts in indexes)
+            filters.insert(0, f"{table}.id IN ({matches})")
+        where = " WHERE " + " AND ".join(filters) if filters else ""
+        arms.append(f"SELECT '{domain}' AS domain, COUNT(*) AS matches FROM {table}{where}")
+    return " UNION ALL ".join(arms)
+
+
+def _search_templates(build: Callable[[tuple[str, ...], bool, bool, bool], str]) -> dict[tuple[Any, ...], str]:
+    """Render build for every search shape, keyed by (domains, has_query, has_from, has_to)."""
+    return {
+        (domains, *flags): build(domains, *flags)
+        for domains in _SEARCH_SUBSETS.values()
+        for flags in product((False, True), repeat=3)
+    }
+
+
+def _record_reader(columns: tuple[str, ...]) -> Callable[[sqlite3.Row], dict[str, Any]]:
+    """Build a domain's record from a search row, picking its columns by position.
+
+    Search rows are (domain, *_SEARCH_COLUMNS, document); itemgetter fetches every
+    column in one C call instead of a name lookup per column.
+    """
+    values = itemgetter(*(1 + _SEARCH_COLUMNS.index(column) for column in columns))
+    if len(columns) == 1:
+        # itemgetter with a single index returns the bare value rather than a 1-tuple
+        return lambda row: {columns[0]: values(row)}
+    return lambda row: dict(zip(columns, values(row)))
+
+
+# Turns a search row into its domain's record
+_SEARCH_RECORD_READERS: dict[str, Callable[[sqlite3.Row], dict[str, Any]]] = {
+    domain: _record_reader(columns) for domain, _, _, columns, _ in _SEARCH_DOMAINS
+}
+_SEARCH_RECORD_READERS["workout"] = lambda row: json.loads(row["document"])
+
+
+_SEARCH_SQL = _search_templates(_search_sql)
+_SEARCH_COUNT_SQL = _search_templates(_search_count_sql)
+
+
+class _TTLCache:
+    """A small thread-safe LRU whose entries also expire after ttl seconds."""
+
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: OrderedDict[Any, tuple[float, Any]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: Any) -> Any | None:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def put(self, key: Any, value: Any) -> None:
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+
+# Keys include the write generation, so any committed write retires every cached search
+_search_cache = _TTLCache(maxsize=256, ttl=30.0)
+
+
+@_tool
 def search_logs(
     query: str,
     domains: Optional[list[str]] = None,
     from_date: Optional[str] = None,
     to_date: Optional[str] = None,
     limit: int = 20,
-) -> dict[str, list[dict[str, Any]]]:
-    """Search across workouts, nutrition days, and body metrics."""
+    estimate_only: bool = False,
+    match_mode: Literal["phrase", "prefix"] = "phrase",
+) -> dict[str, Any]:
+    """Search across workouts, nutrition days, and body metrics.
+
+    With estimate_only, return just the number of matches per domain
+    ({"counts": {...}}) without loading any results. match_mode "prefix" also
+    matches words that start with the query's last word ("deadlift" finds "deadlifts").
+    """
     domains = domains or ["workout", "nutrition", "body"]
-    results = []
+    # Read the generation before the search opens its snapshot: a write committing in
+    # between can only make the cached result newer than its key, never older
+    key = (query, frozenset(domains), from_date, to_date, limit, estimate_only, match_mode, write_generation())
+    result = _search_cache.get(key)
+    if result is None:
+        result = _search_logs(query, domains, from_date, to_date, limit, estimate_only, match_mode)
+        _search_cache.put(key, result)
+    return result
 
-    conn = get_connection()
-    cursor = conn.cursor()
-
-    if "workout" in domains:
-        filters = ["(notes LIKE ? OR workout_type LIKE ? OR tags LIKE ?)"]
-        params = [f"%{query}%", f"%{query}%", f"%{query}%"]
-        if from_date:
-            filters.append("date_time >= ?")
-            params.append(f"{_ensure_date(from_date)}T00:00:00")
-        if to_date:
-            filters.append("date_time <= ?")
-            params.append(f"{_ensure_date(to_date)}T23:59:59")
-        base = "SELECT * FROM workouts WHERE " + " AND ".join(filters) + " LIMIT ?"
-        params.append(limit)
-        cursor.execute(base, params)
-        for row in cursor.fetchall():
-            workout = _hydrate_workout(conn, _row_to_dict(row))
-            results.append({"domain": "workout", "workout": workout})
-
-    if len(results) >= limit:
-        conn.close()
-        return {"results": results[:limit]}
-
-    remaining = limit - len(results)
-
-    if "nutrition" in domains:
-        filters = ["(notes LIKE ?)"]
-        params = [f"%{query}%"]
-        if from_date:
-            filters.append("date >= ?")
-            params.append(_ensure_date(from_date))
-        if to_date:
-            filters.append("date <= ?")
-            params.append(_ensure_date(to_date))
-        base = "SELECT * FROM nutrition_days WHERE " + " AND ".join(filters) + " LIMIT ?"
-        params.append(remaining)
-        cursor.execute(base, params)
-        for row in cursor.fetchall():
-            results.append({"domain": "nutrition", "nutrition": _row_to_dict(row)})
-
-    if len(results) >= limit:
-        conn.close()
-        return {"results": results[:limit]}
-
-    remaining = limit - len(results)
-
-    if "body" in domains:
-        filters = ["(notes LIKE ?)"]
-        params = [f"%{query}%"]
-        if from_date:
-            filters.append("date >= ?")
-            params.append(_ensure_date(from_date))
-        if to_date:
-            filters.append("date <= ?")
-            params.append(_ensure_date(to_date))
-        base = "SELECT * FROM body_metrics WHERE " + " AND ".join(filters) + " LIMIT ?"
-        params.append(remaining)
-        cursor.execute(base, params)
-        for row in cursor.fetchall():
-            results.append({"domain": "body", "body": _row_to_dict(row)})
 
-    conn.close()
+def _search_logs(
+    query: str,
+    domains: list[str],
+    from_date: Optional[str],
+    to_date: Optional[str],
+    limit: int,
+    estimate_only: bool,
+    match_mode: str,
+) -> dict[str, Any]:
+    searched = _SEARCH_SUBSETS.get(_SEARCH_DOMAIN_NAMES.intersection(domains))
+    if searched is None:
+        return {"counts": {}} if estimate_only else {"results": []}
+
+    has_query = bool(query.strip())
+    from_day = from_date and _ensure_date(from_date)
+    to_day = to_date and _ensure_date(to_date)
+    phrase = _fts_phrase(query)
+    # An FTS5 prefix query: the phrase's last token matches any token it starts
+    word_phrase = phrase + "*" if match_mode == "prefix" else phrase
+    bounds = {
+        "date": tuple(day for day in (from_day, to_day) if day),
+        "date_time": tuple(bound for bound in (from_day, to_day and _end_of_day(to_day)) if bound),
+    }
+    shape = (searched, has_query, bool(from_day), bool(to_day))
+
+    # Each arm takes one query parameter per FTS index, then the date bounds
+    arm_params = [
+        tuple(phrase if fts in _TRIGRAM_INDEXES else word_phrase for fts in indexes if has_query)
+        + bounds[date_column]
+        for date_column, indexes in _SEARCH_ARMS[searched]
+    ]
+
+    if estimate_only:
+        params = tuple(value for arm in arm_params for value in arm)
+        with connection() as conn:
+            rows = conn.execute(_SEARCH_COUNT_SQL[shape], params)
+            return {"counts": {row["domain"]: row["matches"] for row in rows}}
+
+    params = tuple(value for arm in arm_params for value in (*arm, limit)) + (limit,)
+
+    results = []
+    # All domains are read by one statement on one snapshot. Running the arms on
+    # separate threads would give each its own snapshot and lose the shared LIMIT,
+    # which stops the later arms as soon as enough rows are found.
+    with connection() as conn:
+        for row in conn.execute(_SEARCH_SQL[shape], params):
+            domain = row["domain"]
+            results.append({"domain": domain, domain: _SEARCH_RECORD_READERS[domain](row)})
+
     return {"results": results}
 
 